@@ -1,6 +1,7 @@
 # coding: utf-8
 
 import logging
+from contextlib import asynccontextmanager
 
 import uvicorn
 import sentry_sdk
@@ -27,6 +28,16 @@ from helpdesk.config import (
 )
 from helpdesk.views.api import router as api_bp
 from helpdesk.views.auth import router as auth_bp
+from helpdesk.libs.notification import close_http_client, close_smtp_client
+
+
+@asynccontextmanager
+async def lifespan(app):
+    yield
+    try:
+        await close_http_client()
+    finally:
+        await close_smtp_client()
 
 
 def create_app():
@@ -61,7 +72,7 @@ def create_app():
         Middleware(SentryMiddleware),
     ]
 
-    app = FastAPI(debug=DEBUG, middleware=enabled_middlewares)
+    app = FastAPI(debug=DEBUG, middleware=enabled_middlewares, lifespan=lifespan)
     app.include_router(api_bp, prefix="/api")
     app.include_router(auth_bp, prefix="/auth")
 
@@ -1,17 +1,25 @@
 # coding: utf-8
 
+import asyncio
+from collections import defaultdict
 import copy
 from datetime import datetime
+import html
+from itertools import chain
 import logging
-import smtplib
+import random
+import time
 from email.message import EmailMessage
 from typing import Tuple
+from zoneinfo import ZoneInfo
 
-import requests
-from pytz import timezone
+import aiosmtplib
+import httpx
+from jinja2 import FileSystemBytecodeCache
 from starlette.templating import Jinja2Templates
 
 from helpdesk.config import (
+    DEBUG,
     NOTIFICATION_TITLE_PREFIX,
     WEBHOOK_URL,
     WEBHOOK_EVENT_URL,
@@ -32,20 +40,199 @@ from helpdesk.views.api.schemas import NodeType, NotifyMessage
 logger = logging.getLogger(__name__)
 
 
+_TZ_LOCAL = ZoneInfo(TIME_ZONE)
+_TZ_UTC = ZoneInfo("UTC")
+
+
 def timeLocalize(value):
-    tz = timezone(TIME_ZONE)
-    utc = timezone("Etc/UTC")
-    dt = value
-    dt_with_timezone = utc.localize(dt)
-    return dt_with_timezone.astimezone(tz).strftime(TIME_FORMAT)
+    return value.replace(tzinfo=_TZ_UTC).astimezone(_TZ_LOCAL).strftime(TIME_FORMAT)
 
 
 _templates = Jinja2Templates(directory="templates/notification")
 _templates.env.filters["timeLocalize"] = timeLocalize
+if not DEBUG:
+    # templates don't change at runtime, skip the stat on each lookup
+    # and keep compiled bytecode across restarts
+    _templates.env.auto_reload = False
+    _templates.env.bytecode_cache = FileSystemBytecodeCache()
+
+
+class CircuitBreaker:
+    """
+    per destination circuit breaker
+    closed -> open after `failure_threshold` failures within `window` seconds,
+    open -> half_open once `cooldown` seconds passed, letting a single probe through,
+    half_open -> closed on the probe's success or back to open on failure
+    """
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(
+        self, failure_threshold=5, window=30, cooldown=10, clock=time.monotonic
+    ):
+        self.clock = clock
+        self.failure_threshold = failure_threshold
+        self.window = window
+        self.cooldown = cooldown
+        self.state = self.CLOSED
+        self.failures = 0
+        self.first_failure_at = 0.0
+        self.opened_at = 0.0
+
+    def allow(self):
+        if self.state == self.CLOSED:
+            return True
+        now = self.clock()
+        if now - self.opened_at < self.cooldown:
+            return False
+        # let a single probe through, another one only if the previous
+        # probe hasn't reported back within `cooldown`
+        self.state = self.HALF_OPEN
+        self.opened_at = now
+        return True
+
+    def on_success(self):
+        self.state = self.CLOSED
+        self.failures = 0
+
+    def on_failure(self):
+        now = self.clock()
+        if self.state == self.HALF_OPEN:
+            self._open(now)
+            return
+        if now - self.first_failure_at > self.window:
+            self.failures = 0
+            self.first_failure_at = now
+        self.failures += 1
+        if self.failures >= self.failure_threshold:
+            self._open(now)
+
+    def _open(self, now):
+        self.state = self.OPEN
+        self.opened_at = now
+        self.failures = 0
+
+
+_breakers = defaultdict(CircuitBreaker)
+# bound in-flight posts per destination, excess sends wait on the semaphore
+_bulkheads = defaultdict(lambda: asyncio.Semaphore(8))
+
+_http = None
+
+_RETRY_BASE = 0.2
+_RETRY_CAP = 5.0
+# overall budget for one post including bulkhead wait, retries and backoff,
+# notifications are awaited inline by request handlers
+_POST_DEADLINE = 5.0
+
+
+def _get_http():
+    global _http
+    if _http is None or _http.is_closed:
+        _http = httpx.AsyncClient(
+            http2=True,
+            timeout=httpx.Timeout(3.0),
+            limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        )
+    return _http
+
+
+async def close_http_client():
+    global _http
+    client, _http = _http, None
+    if client is not None:
+        await client.aclose()
+
+
+async def _post_with_retry(url, max_attempts=4, **kwargs):
+    """
+    retry transient failures (network errors, 5xx and 429)
+    with exponential backoff and full jitter, other 4xx are returned as is
+    """
+    for attempt in range(1, max_attempts + 1):
+        try:
+            r = await _get_http().post(url, **kwargs)
+        except httpx.TransportError:
+            if attempt == max_attempts:
+                raise
+        else:
+            if (
+                r.status_code < 500 and r.status_code != 429
+            ) or attempt == max_attempts:
+                return r
+        backoff = min(_RETRY_CAP, _RETRY_BASE * 2 ** (attempt - 1))
+        await asyncio.sleep(random.uniform(0, backoff))
+
+
+async def _post(url, **kwargs):
+    """
+    post to `url` through its circuit breaker and bulkhead within `_POST_DEADLINE`,
+    returns None without sending when the circuit is open
+    """
+    breaker = _breakers[url]
+    if not breaker.allow():
+        logger.warning("circuit open for %s, skip notification", url)
+        return None
+    try:
+        async with asyncio.timeout(_POST_DEADLINE):
+            async with _bulkheads[url]:
+                r = await _post_with_retry(url, **kwargs)
+    except (httpx.TransportError, TimeoutError):
+        breaker.on_failure()
+        raise
+    if r.status_code >= 500 or r.status_code == 429:
+        breaker.on_failure()
+    else:
+        breaker.on_success()
+    return r
+
+
+_SMTP_USER, _SMTP_PASSWORD = (
+    SMTP_CREDENTIALS.split(":", 1) if SMTP_CREDENTIALS else (None, None)
+)
+_SUBMITTER_NOTIFY_PHASES = frozenset({"approval", "mark"})
+
+_smtp = None
+_smtp_lock = asyncio.Lock()
+
+
+async def _get_smtp():
+    global _smtp
+    async with _smtp_lock:
+        if _smtp is None or not _smtp.is_connected:
+            smtp = aiosmtplib.SMTP(
+                hostname=SMTP_SERVER,
+                port=SMTP_SERVER_PORT,
+                use_tls=SMTP_SSL,
+                start_tls=False,
+                # smtplib.SMTP_SSL without a context never verified the server
+                # certificate, keep that for servers with self-signed/internal certs
+                validate_certs=False,
+            )
+            await smtp.connect()
+            if _SMTP_USER:
+                try:
+                    await smtp.login(_SMTP_USER, _SMTP_PASSWORD)
+                except Exception:
+                    smtp.close()
+                    raise
+            _smtp = smtp
+        return _smtp
+
+
+async def close_smtp_client():
+    global _smtp
+    async with _smtp_lock:
+        if _smtp is not None and _smtp.is_connected:
+            await _smtp.quit()
+        _smtp = None
 
 
 class Notification:
     method = None
+    _template_cache = {}
 
     def __init__(self, phase, ticket):
         self.phase = phase
@@ -54,16 +241,23 @@ class Notification:
     async def send(self):
         raise NotImplementedError
 
+    def get_template(self):
+        key = f"{self.method}/{self.phase.value}.j2"
+        if DEBUG:
+            return _templates.get_template(key)
+        template = Notification._template_cache.get(key)
+        if template is None:
+            template = _templates.get_template(key)
+            Notification._template_cache[key] = template
+        return template
+
     def render(self):
-        import xml.etree.ElementTree as ET
-
-        message = _templates.get_template(
-            f"{self.method}/{self.phase.value}.j2"
-        ).render(dict(ticket=self.ticket))
-        logger.debug("render_notification: message: %s", message)
-        tree = ET.fromstring(message.strip())
-        title = "".join(piece.text for piece in tree.findall("title"))
-        content = "".join(piece.text for piece in tree.findall("content"))
+        template = self.get_template()
+        context = template.new_context(dict(ticket=self.ticket))
+        # templates are autoescaped, but notifications are plain text
+        title = html.unescape("".join(template.blocks["title"](context)))
+        content = html.unescape("".join(template.blocks["content"](context)))
+        logger.debug("render_notification: title: %s, content: %s", title, content)
         return title, content
 
 
@@ -71,32 +265,33 @@ class MailNotification(Notification):
     method = "mail"
 
     async def get_mail_addrs(self):
-        email_addrs = (
-            [ADMIN_EMAIL_ADDRS]
-            + [get_user_email(cc) for cc in self.ticket.ccs]
-            + self.ticket.annotation.get("approvers").split(",")
+        rule_approvers = await self.ticket.get_rule_actions("approver")
+        email_addrs = chain(
+            ADMIN_EMAIL_ADDRS.split(","),
+            (get_user_email(cc) for cc in self.ticket.ccs),
+            self.ticket.annotation.get("approvers").split(","),
+            (get_user_email(approver) for approver in rule_approvers),
+            (
+                [get_user_email(self.ticket.submitter)]
+                if self.phase.value in _SUBMITTER_NOTIFY_PHASES
+                else ()
+            ),
         )
-        email_addrs += [
-            get_user_email(approver)
-            for approver in await self.ticket.get_rule_actions("approver")
-        ]
-        if self.phase.value in ("approval", "mark"):
-            email_addrs += [get_user_email(self.ticket.submitter)]
-        email_addrs = ",".join(addr for addr in email_addrs if addr)
-        return email_addrs
+        # dedup while keeping the order addresses were added in
+        return ",".join(dict.fromkeys(addr for addr in email_addrs if addr))
 
     async def send(self):
+        if not SMTP_SERVER:
+            return
         addrs = await self.get_mail_addrs()
+        if not addrs:
+            return
+        breaker = _breakers[SMTP_SERVER]
+        if not breaker.allow():
+            logger.warning("circuit open for %s, skip notification", SMTP_SERVER)
+            return
         title, content = self.render()
 
-        server_info = (SMTP_SERVER, SMTP_SERVER_PORT)
-        smtp = (
-            smtplib.SMTP_SSL(*server_info) if SMTP_SSL else smtplib.SMTP(*server_info)
-        )
-        if SMTP_CREDENTIALS:
-            user, password = SMTP_CREDENTIALS.split(":")
-            smtp.login(user, password)
-
         msg = EmailMessage()
         msg.set_content(content.strip())
         msg["Subject"] = NOTIFICATION_TITLE_PREFIX + title
@@ -104,9 +299,29 @@ class MailNotification(Notification):
         msg["To"] = addrs
 
         try:
-            smtp.send_message(msg)
-        finally:
-            smtp.quit()
+            smtp = await _get_smtp()
+            try:
+                await smtp.send_message(msg)
+            except aiosmtplib.SMTPServerDisconnected:
+                # the pooled connection was dropped by the server, reconnect once
+                smtp.close()
+                smtp = await _get_smtp()
+                await smtp.send_message(msg)
+        except (
+            aiosmtplib.SMTPConnectError,
+            aiosmtplib.SMTPTimeoutError,
+            aiosmtplib.SMTPServerDisconnected,
+            aiosmtplib.SMTPAuthenticationError,
+            OSError,
+        ):
+            # only server side failures trip the breaker,
+            # per message rejections mean the server itself is healthy
+            breaker.on_failure()
+            raise
+        except aiosmtplib.SMTPException:
+            breaker.on_success()
+            raise
+        breaker.on_success()
 
 
 class WebhookNotification(Notification):
@@ -143,24 +358,28 @@ class WebhookNotification(Notification):
             "text": f"{title}\n{link}\n{content}",
             "markdown": content,
         }
-        r = requests.post(WEBHOOK_URL, json=msg, timeout=3)
-        r.raise_for_status()
+        r = await _post(WEBHOOK_URL, json=msg)
+        if r is not None:
+            r.raise_for_status()
 
 
 class WebhookEventNotification(Notification):
     method = "webhook"
 
     def render(self):
-        nodes = self.ticket.annotation.get("nodes")
-        next_node = ("",)
-        approvers = self.ticket.annotation.get("approvers")
+        annotation = self.ticket.annotation
+        current_node = annotation.get("current_node")
+        nodes = annotation.get("nodes") or []
+        next_node = ""
+        notify_type = ""
+        approvers = annotation.get("approvers")
         notify_people = approvers
         for index, node in enumerate(nodes):
-            if self.ticket.annotation.get("current_node") == node.get("name"):
-                next_node = (
-                    nodes[index + 1].get("name") if (index != len(nodes) - 1) else ""
-                )
+            if node.get("name") == current_node:
                 notify_type = node.get("node_type")
+                if index + 1 < len(nodes):
+                    next_node = nodes[index + 1].get("name")
+                break
 
         if self.phase.value in (TicketPhase.APPROVAL.value, TicketPhase.MARK.value) or (
             self.phase.value == "request" and self.ticket.status == "closed"
@@ -172,13 +391,13 @@ class WebhookEventNotification(Notification):
             else:
                 notify_people = approvers + "," + self.ticket.submitter
             approvers = ""
-        approval_log = copy.deepcopy(self.ticket.annotation.get("approval_log"))
+        approval_log = copy.deepcopy(annotation.get("approval_log"))
         for log in approval_log:
             format = "%Y-%m-%d %H:%M:%S"
             log["operated_at"] = (
-                timezone("Etc/UTC")
-                .localize(datetime.strptime(log.get("operated_at"), format))
-                .astimezone(timezone(TIME_ZONE))
+                datetime.strptime(log.get("operated_at"), format)
+                .replace(tzinfo=_TZ_UTC)
+                .astimezone(_TZ_LOCAL)
                 .strftime(format)
             )
 
@@ -191,12 +410,12 @@ class WebhookEventNotification(Notification):
                 "is_approved": self.ticket.is_approved or False,
                 "submitter": self.ticket.submitter,
                 "params": self.ticket.params,
-                "request_time": timezone("Etc/UTC")
-                .localize(self.ticket.created_at)
-                .astimezone(timezone(TIME_ZONE)),
+                "request_time": self.ticket.created_at.replace(
+                    tzinfo=_TZ_UTC
+                ).astimezone(_TZ_LOCAL),
                 "reason": self.ticket.reason or "",
-                "approval_flow": self.ticket.annotation.get("policy"),
-                "current_node": self.ticket.annotation.get("current_node"),
+                "approval_flow": annotation.get("policy"),
+                "current_node": current_node,
                 "approvers": approvers,
                 "next_node": next_node,
                 "approval_log": approval_log,
@@ -210,10 +429,17 @@ class WebhookEventNotification(Notification):
         if not WEBHOOK_EVENT_URL:
             return
         message = self.render()
-        r = requests.post(
-            WEBHOOK_EVENT_URL, json=message.model_dump(mode="json")
+        # serialize once, the same bytes are reused across retries
+        payload = message.model_dump_json().encode()
+        r = await _post(
+            WEBHOOK_EVENT_URL,
+            content=payload,
+            headers={"Content-Type": "application/json"},
         )
-        print(r.status_code, r.text)
+        if r is None:
+            return
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("webhook event response: %s %s", r.status_code, r.text)
         if r.status_code == 200:
             return
         else:
@@ -1,5 +1,6 @@
 # coding: utf-8
 
+import asyncio
 import logging
 import importlib
 from enum import Enum
@@ -405,7 +406,7 @@ class Ticket(db.Model):
         logger.info("Ticket notify: %s: %s", phase, self)
         assert isinstance(phase, TicketPhase)
 
-        for method in NOTIFICATION_METHODS:
+        async def _notify(method):
             module, _class = method.split(":")
             try:
                 notify = getattr(importlib.import_module(module), _class)
@@ -414,6 +415,9 @@ class Ticket(db.Model):
                 report()
                 logger.warning("notify to %s failed: %s", method, e)
 
+        # backends are independent, send to all of them concurrently
+        await asyncio.gather(*(_notify(method) for method in NOTIFICATION_METHODS))
+
     def generate_callback_url(self):
         """
         generate callback url for ticket mark status call back
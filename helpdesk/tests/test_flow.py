@@ -1,6 +1,8 @@
 from datetime import datetime
 import pytest
+from pytest import MonkeyPatch
 from helpdesk.models.db.ticket import Ticket, TicketPhase
+from helpdesk.libs import notification
 from helpdesk.libs.notification import MailNotification, WebhookEventNotification
 from helpdesk.views.api.schemas import NodeType
 
@@ -105,11 +107,12 @@ async def test_flow_match(
 
 @pytest.mark.anyio
 @pytest.mark.parametrize(
-    "phase, params, mail_approvers, notify_approvers, notify_type, notify_people",
+    "phase, params, admin_email_addrs, mail_approvers, notify_approvers, notify_type, notify_people",
     [
         pytest.param(
             TicketPhase.REQUEST,
             {},
+            "",
             "test_user",
             "test_user",
             NodeType.APPROVAL,
@@ -118,14 +121,26 @@ async def test_flow_match(
         pytest.param(
             TicketPhase.APPROVAL,
             {},
+            "",
             "test_user,admin_user@example.com",
             "",
             NodeType.CC,
             "test_user,admin_user",
         ),
+        # 管理员邮箱与提交人重复时只发送一次
+        pytest.param(
+            TicketPhase.APPROVAL,
+            {},
+            "admin_user@example.com,ops@example.com",
+            "admin_user@example.com,ops@example.com,test_user",
+            "",
+            NodeType.CC,
+            "test_user,admin_user",
+        ),
         pytest.param(
             TicketPhase.MARK,
             {},
+            "",
             "test_user,admin_user@example.com",
             "",
             NodeType.CC,
@@ -136,17 +151,20 @@ async def test_flow_match(
             {"reason": "test_cc_policy_to_submitter"},
             "",
             "",
+            "",
             NodeType.CC,
             "admin_user",
         ),
     ],
 )
 async def test_mail_notify(
+    monkeypatch: MonkeyPatch,
     test_action,
     test_admin_user,
     test_all_policy,
     phase,
     params,
+    admin_email_addrs,
     mail_approvers,
     notify_approvers,
     notify_type,
@@ -173,6 +191,7 @@ async def test_mail_notify(
     ticket.annotate(current_node=current_node)
     approvers = await ticket.get_node_approvers(current_node)
     ticket.annotate(approvers=approvers)
+    monkeypatch.setattr(notification, "ADMIN_EMAIL_ADDRS", admin_email_addrs)
     mail_notify = MailNotification(phase, ticket)
     mail_addrs = await mail_notify.get_mail_addrs()
     assert mail_addrs == mail_approvers
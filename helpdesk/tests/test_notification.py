@@ -0,0 +1,307 @@
+import asyncio
+from collections import defaultdict
+from datetime import datetime
+import aiosmtplib
+import httpx
+import pytest
+from pytest import MonkeyPatch
+from helpdesk.libs import notification
+from helpdesk.libs.notification import (
+    CircuitBreaker,
+    MailNotification,
+    WebhookEventNotification,
+    WebhookNotification,
+)
+from helpdesk.models.db.ticket import Ticket, TicketPhase
+
+
+def test_circuit_breaker():
+    now = 100.0
+    breaker = CircuitBreaker(
+        failure_threshold=2, window=30, cooldown=10, clock=lambda: now
+    )
+    assert breaker.allow()
+
+    # 达到失败阈值后熔断
+    breaker.on_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.on_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+    # 冷却结束后半开, 再次失败重新熔断
+    now += 10
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    # 半开状态下只放行一个探测请求
+    assert not breaker.allow()
+    breaker.on_failure()
+    assert breaker.state == CircuitBreaker.OPEN
+
+    # 半开状态下成功则恢复
+    now += 10
+    assert breaker.allow()
+    breaker.on_success()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+def test_circuit_breaker_window():
+    now = 100.0
+    breaker = CircuitBreaker(
+        failure_threshold=2, window=30, cooldown=10, clock=lambda: now
+    )
+
+    # 超出统计窗口的失败不累计
+    breaker.on_failure()
+    now += 31
+    breaker.on_failure()
+    assert breaker.state == CircuitBreaker.CLOSED
+
+
+@pytest.mark.anyio
+async def test_post_with_retry(monkeypatch: MonkeyPatch):
+    status_codes = [503, 429, 200]
+
+    def handler(request):
+        return httpx.Response(status_codes.pop(0))
+
+    monkeypatch.setattr(notification.random, "uniform", lambda a, b: 0)
+    monkeypatch.setattr(
+        notification, "_http", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+    r = await notification._post_with_retry("http://webhook.example.com", json={})
+    assert r.status_code == 200
+    assert status_codes == []
+
+    # 非 429 的 4xx 不重试
+    status_codes = [400, 200]
+    r = await notification._post_with_retry("http://webhook.example.com", json={})
+    assert r.status_code == 400
+    assert status_codes == [200]
+
+
+@pytest.mark.anyio
+async def test_post_deadline(monkeypatch: MonkeyPatch):
+    async def handler(request):
+        await asyncio.sleep(1)
+        return httpx.Response(200)
+
+    monkeypatch.setattr(notification, "_POST_DEADLINE", 0.05)
+    monkeypatch.setattr(notification, "_breakers", defaultdict(CircuitBreaker))
+    monkeypatch.setattr(
+        notification, "_http", httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    )
+    # 整体超时后放弃发送并计入熔断失败次数
+    with pytest.raises(TimeoutError):
+        await notification._post("http://webhook.example.com", json={})
+    assert notification._breakers["http://webhook.example.com"].failures == 1
+
+
+PARAMS_CONTENT = """Parameters:
+    - app: a&b<c>"d'
+Request time: {created_at}
+Reason: r&<"'"""
+
+
+@pytest.mark.parametrize(
+    "notification_class, phase, title, content",
+    [
+        pytest.param(
+            MailNotification,
+            TicketPhase.REQUEST,
+            "admin_user request to x & <y>",
+            "Ticket: {web_url}\n" + PARAMS_CONTENT + "\n\n"
+            "Do you want to approve this request?\n"
+            "Approve: {web_url}/approve\n"
+            "Reject: {web_url}/reject",
+        ),
+        pytest.param(
+            MailNotification,
+            TicketPhase.APPROVAL,
+            "admin_user's request to x & <y> was rejected by test_user ",
+            "Ticket: {web_url}\n" + PARAMS_CONTENT + "\nApproval flow: p&<q>",
+        ),
+        pytest.param(
+            MailNotification,
+            TicketPhase.MARK,
+            "admin_user's request to x & <y> has been marked as rejected ",
+            "Ticket: {web_url}\n" + PARAMS_CONTENT + "\n"
+            "Status: rejected\n"
+            "Reject time: {confirmed_at}",
+        ),
+        pytest.param(
+            WebhookNotification,
+            TicketPhase.REQUEST,
+            "admin_user request to x & <y>",
+            PARAMS_CONTENT + "\n"
+            "Do you want to approve this request?\n"
+            "Approve: {web_url}/approve\n"
+            "Reject: {web_url}/reject",
+        ),
+        pytest.param(
+            WebhookNotification,
+            TicketPhase.APPROVAL,
+            "admin_user's request to x & <y> was rejected by test_user ",
+            PARAMS_CONTENT + "\nApproval flow: p&<q>",
+        ),
+        pytest.param(
+            WebhookNotification,
+            TicketPhase.MARK,
+            "admin_user's request to x & <y> has been marked as rejected ",
+            PARAMS_CONTENT + "\nStatus: rejected\nReject time: {confirmed_at}",
+        ),
+    ],
+)
+def test_render(notification_class, phase, title, content):
+    # 模板渲染结果不应被自动转义
+    ticket = Ticket(
+        id=1,
+        title="x & <y>",
+        params={"app": "a&b<c>\"d'", "reason": "r&<\"'"},
+        submitter="admin_user",
+        reason="r&<\"'",
+        is_approved=False,
+        created_at=datetime(2024, 1, 1),
+        confirmed_at=datetime(2024, 1, 1, 1),
+        annotation={
+            "policy": "p&<q>",
+            "approval_log": [{"operated_type": "rejected", "approver": "test_user"}],
+        },
+    )
+    rendered_title, rendered_content = notification_class(phase, ticket).render()
+    assert rendered_title == title
+    assert rendered_content.strip() == content.format(
+        web_url=ticket.web_url,
+        # TIME_ZONE = "Asia/Shanghai"
+        created_at="2024-01-01 08:00:00 +0800 Mon",
+        confirmed_at="2024-01-01 09:00:00 +0800 Mon",
+    )
+
+
+def test_webhook_event_render_time():
+    ticket = Ticket(
+        id=1,
+        title="test",
+        params={},
+        submitter="admin_user",
+        is_approved=False,
+        created_at=datetime(2024, 1, 1),
+        annotation={
+            "policy": "test_policy",
+            "nodes": [{"name": "test_node", "node_type": "approval"}],
+            "current_node": "test_node",
+            "approvers": "test_user",
+            "approval_log": [
+                {
+                    "approver": "test_user",
+                    "operated_type": "rejected",
+                    "operated_at": "2024-01-01 01:00:00",
+                }
+            ],
+        },
+    )
+    message = WebhookEventNotification(TicketPhase.APPROVAL, ticket).render()
+    # 数据库中的 UTC 时间转换为 TIME_ZONE = "Asia/Shanghai"
+    assert message.request_time.isoformat() == "2024-01-01T08:00:00+08:00"
+    assert [log["operated_at"] for log in message.approval_log] == [
+        "2024-01-01 09:00:00"
+    ]
+    # 不修改工单中记录的原始时间
+    assert ticket.annotation["approval_log"][0]["operated_at"] == "2024-01-01 01:00:00"
+
+
+class FakeSMTP:
+    instances = []
+    send_errors = []
+    login_error = None
+
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+        self.is_connected = False
+        self.closed = False
+        self.sent = []
+        FakeSMTP.instances.append(self)
+
+    async def connect(self):
+        self.is_connected = True
+
+    async def login(self, user, password):
+        if FakeSMTP.login_error:
+            raise FakeSMTP.login_error
+
+    async def send_message(self, msg):
+        if FakeSMTP.send_errors:
+            self.is_connected = False
+            raise FakeSMTP.send_errors.pop(0)
+        self.sent.append(msg)
+
+    def close(self):
+        self.is_connected = False
+        self.closed = True
+
+    async def quit(self):
+        self.close()
+
+
+@pytest.fixture
+def fake_smtp(monkeypatch: MonkeyPatch):
+    monkeypatch.setattr(FakeSMTP, "instances", [])
+    monkeypatch.setattr(FakeSMTP, "send_errors", [])
+    monkeypatch.setattr(FakeSMTP, "login_error", None)
+    monkeypatch.setattr(notification.aiosmtplib, "SMTP", FakeSMTP)
+    monkeypatch.setattr(notification, "_smtp", None)
+    monkeypatch.setattr(notification, "_breakers", defaultdict(CircuitBreaker))
+    monkeypatch.setattr(notification, "SMTP_SERVER", "smtp.example.com")
+
+    async def mock_get_mail_addrs(self):
+        return "test_user@example.com"
+
+    monkeypatch.setattr(MailNotification, "get_mail_addrs", mock_get_mail_addrs)
+    monkeypatch.setattr(MailNotification, "render", lambda self: ("title", "content"))
+    yield FakeSMTP
+
+
+@pytest.mark.anyio
+async def test_mail_reuse_connection(fake_smtp):
+    await MailNotification(TicketPhase.REQUEST, None).send()
+    await MailNotification(TicketPhase.REQUEST, None).send()
+    # 连接在多次发送间复用
+    assert len(fake_smtp.instances) == 1
+    assert len(fake_smtp.instances[0].sent) == 2
+
+    await notification.close_smtp_client()
+    assert fake_smtp.instances[0].closed
+    assert notification._smtp is None
+
+
+@pytest.mark.anyio
+async def test_mail_reconnect_once(fake_smtp):
+    await MailNotification(TicketPhase.REQUEST, None).send()
+    # 连接被服务端断开后只重连并重发一次
+    fake_smtp.send_errors.append(aiosmtplib.SMTPServerDisconnected("gone"))
+    await MailNotification(TicketPhase.REQUEST, None).send()
+    assert len(fake_smtp.instances) == 2
+    assert fake_smtp.instances[0].closed
+    assert len(fake_smtp.instances[1].sent) == 1
+
+    fake_smtp.send_errors.extend(
+        [
+            aiosmtplib.SMTPServerDisconnected("gone"),
+            aiosmtplib.SMTPServerDisconnected("gone again"),
+        ]
+    )
+    with pytest.raises(aiosmtplib.SMTPServerDisconnected):
+        await MailNotification(TicketPhase.REQUEST, None).send()
+    assert len(fake_smtp.instances) == 3
+
+
+@pytest.mark.anyio
+async def test_mail_login_failed(monkeypatch: MonkeyPatch, fake_smtp):
+    monkeypatch.setattr(notification, "_SMTP_USER", "user")
+    monkeypatch.setattr(notification, "_SMTP_PASSWORD", "password")
+    fake_smtp.login_error = aiosmtplib.SMTPAuthenticationError(535, "bad credentials")
+    # 登录失败时关闭连接且不缓存
+    with pytest.raises(aiosmtplib.SMTPAuthenticationError):
+        await notification._get_smtp()
+    assert fake_smtp.instances[0].closed
+    assert notification._smtp is None